@@ -10,6 +10,9 @@ def modify_command_options(opts):
     if opts.dataset == 'dent':
         opts.num_classes = 4
 
+    if opts.dali and opts.dataset != 'dent':
+        raise NotImplementedError("DALI is only supported for the dent dataset")
+
     if not opts.visualize:
         opts.sample_num = 0
 
@@ -62,6 +65,12 @@ def get_argparser():
     # Annotation path for our dataset
     parser.add_argument("--annot_root", type=str, default='./AnnotationFiles',
                         help="path to Annotation file")
+    # Cache of preprocessed samples for our dataset
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="path to the cache of preprocessed samples (default: None, no cache)")
+    # GPU preprocessing with NVIDIA DALI for our dataset
+    parser.add_argument("--dali", action='store_true', default=False,
+                        help="decode and preprocess images on the GPU with DALI, only for dent (default: False)")
     parser.add_argument("--dataset", type=str, default='voc',
                         choices=['voc', 'ade', 'dent'], help='Name of dataset')
     parser.add_argument("--num_classes", type=int, default=None,
@@ -0,0 +1,105 @@
+import math
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+from nvidia.dali import fn, pipeline_def, types
+from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+
+from .dent import CocoDataset
+
+
+class CocoExternalSource:
+    """
+    Feeds a DALI pipeline with the encoded images of a CocoDataset, one
+    sample per call. Only the image header is read on the CPU, to compute
+    how the image is resized and padded. The mask is built on the CPU with
+    the same geometry. Calls run in DALI's parallel python workers, so the
+    object is pickled to each of them.
+    Arguments:
+        dataset (CocoDataset): The dataset to read
+        indices (sequence): Indices of the samples to read, in order
+        dim (int): Size of the square output images
+    """
+
+    def __init__(self, dataset, indices, dim=1024):
+        self.dataset = dataset
+        self.indices = indices
+        self.dim = dim
+
+    def __call__(self, sample_info):
+        if sample_info.idx_in_epoch >= len(self.indices):
+            raise StopIteration
+        path, anns = self.dataset.images[self.indices[sample_info.idx_in_epoch]]
+        path = os.path.join(self.dataset.root, path)
+        with Image.open(path) as im:
+            width, height = im.size
+        window, _, padding = self.dataset.square_geometry((height, width), self.dim)
+        (top_pad, _), (left_pad, _) = padding[:2]
+        encoded = np.fromfile(path, dtype=np.uint8)
+        size = np.array([window[2] - top_pad, window[3] - left_pad], dtype=np.float32)
+        # a negative start pads the resized image with zeros
+        start = np.array([-top_pad, -left_pad], dtype=np.float32)
+        mask = self.dataset.build_mask(anns, (height, width), window, padding)
+        return encoded, size, start, mask
+
+
+@pipeline_def
+def coco_pipeline(source, dim=1024):
+    """Decodes, resizes and pads the images on the GPU."""
+    encoded, sizes, starts, masks = fn.external_source(
+        source=source, num_outputs=4, batch=False, parallel=True,
+        dtype=[types.UINT8, types.FLOAT, types.FLOAT, types.UINT8])
+    # the geometry and the mask are computed from the unrotated size, as in
+    # CocoDataset.load_image() the EXIF orientation is ignored
+    images = fn.decoders.image(encoded, device='mixed', output_type=types.RGB,
+                               adjust_orientation=False)
+    # bilinear without antialiasing, as cv2.resize() in CocoDataset.resize()
+    images = fn.resize(images, size=sizes, interp_type=types.INTERP_LINEAR, antialias=False)
+    images = fn.slice(images, start=starts, shape=[dim, dim], axis_names="HW",
+                      out_of_bounds_policy="pad", fill_values=0)
+    # float CHW in the 0-255 range, the same input as the CPU path
+    images = fn.crop_mirror_normalize(images, dtype=types.FLOAT, output_layout="CHW")
+    return images, masks.gpu()
+
+
+class DaliLoader:
+    """
+    Drop-in replacement of the DataLoader of a CocoDataset, where the images
+    are decoded with nvJPEG and preprocessed on the GPU by DALI.
+    Batches are (image, mask) pairs already on the GPU, images are
+    float32 CHW tensors in the 0-255 range and masks uint8 tensors.
+    Arguments:
+        dataset (CocoDataset or Subset of it): The dataset to read
+        batch_size (int): Number of samples in a batch
+        num_threads (int): Number of CPU threads used by DALI
+        py_num_workers (int): Number of processes building the masks, the
+            counterpart of the DataLoader num_workers
+        device_id (int): GPU used by DALI
+    """
+
+    def __init__(self, dataset, batch_size, num_threads=4, py_num_workers=4, device_id=0):
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset, indices = dataset.dataset, list(dataset.indices)
+        else:
+            indices = list(range(len(dataset)))
+        assert isinstance(dataset, CocoDataset), "DALI is only supported for the dent dataset"
+        self.size = len(indices)
+        self.batch_size = batch_size
+        source = CocoExternalSource(dataset, indices)
+        # spawn, as the loaders for testing are built once CUDA is initialized
+        pipe = coco_pipeline(source, batch_size=batch_size, num_threads=max(1, num_threads),
+                             py_num_workers=max(1, py_num_workers), py_start_method='spawn',
+                             device_id=device_id)
+        pipe.build()
+        self.iterator = DALIGenericIterator([pipe], ["image", "mask"],
+                                            last_batch_policy=LastBatchPolicy.PARTIAL,
+                                            auto_reset=True)
+
+    def __iter__(self):
+        for batch in self.iterator:
+            yield batch[0]["image"], batch[0]["mask"]
+
+    def __len__(self):
+        return math.ceil(self.size / self.batch_size)
@@ -2,17 +2,24 @@ import torch
 import torchvision.transforms as transforms
 import torch.utils.data as data
 import os
+import hashlib
 import numpy as np
 from PIL import Image
 
 import random
-import scipy
-import warnings
+from tqdm import tqdm
 from pycocotools.coco import COCO
-import skimage.color
-import skimage.io
-import skimage.transform
-from distutils.version import LooseVersion
+import pycocotools.mask as mask_utils
+from .utils import SerializedList
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+    import skimage.transform
+try:
+    from .rasterize import rasterize_polys
+except ImportError:
+    rasterize_polys = None
 
 from PIL import Image
 
@@ -25,14 +32,23 @@ classes = [
 
 class CocoDataset(data.Dataset):
     """COCO Custom Dataset compatible with torch.utils.data.DataLoader."""
-    def __init__(self, root, annot_path, step, transform=None, test=False):
+    # number of annotations decoded at once by mask_utils.decode()
+    decode_chunk = 16
+
+    def __init__(self, root, annot_path, step, test=False, cache_dir=None):
         """Set the path for images
-        
+
+        Images are returned as uint8 CHW tensors, the Trainer converts them
+        to float once the batch is on the device.
+
         Args:
             root: image directory.
             annot_path: coco annotation file path.
             step: indicate the dataset that has been used.
-            transform: image transformer.
+            cache_dir: if provided, preprocessed samples are stored in this
+                directory the first time they are loaded and read back from
+                it afterwards. If pack_cache() has been run for this dataset,
+                all the samples are read from a single packed file instead.
         """
         if step == 0:
             self.root = os.path.join(root, "PERM")
@@ -42,49 +58,282 @@ class CocoDataset(data.Dataset):
             self.root = os.path.join(root, "filling")
         else:
             self.root = root
-        self.coco = COCO(annot_path)
-        self.ids = list(self.coco.imgs.keys())
+        coco = COCO(annot_path)
+        self.ids = list(coco.imgs.keys())
+        cat_ids = coco.getCatIds()
+        # Keep only what __getitem__ needs, serialized in a single buffer so
+        # that the DataLoader workers share it instead of copying the COCO index.
+        # Annotations are looked up once here instead of at every sample.
+        self.images = SerializedList([
+            (coco.imgs[img_id]['file_name'],
+             coco.loadAnns(coco.getAnnIds(imgIds=img_id, catIds=cat_ids, iscrowd=None)))
+            for img_id in self.ids])
         self.step = step
-        self.transform = transform
         self.test = test
+        # scratch buffer for the padded image, allocated by each worker
+        self.image_buffer = None
+        self.cache_dir = None
+        if cache_dir is not None:
+            # image ids are only unique within an annotation file, and the
+            # cached masks are only valid for its current content
+            name = os.path.splitext(os.path.basename(annot_path))[0]
+            self.cache_dir = os.path.join(cache_dir, f"{name}-{self.fingerprint(annot_path)}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+        # memmaps of the packed cache, opened by each worker
+        self.packed = None
 
     def __getitem__(self, index):
         """Returns one data pair (image and mask)."""
-        img_id = self.ids[index]
-
-        path = self.coco.loadImgs(img_id)[0]['file_name']
-        image = Image.open(os.path.join(self.root, path)).convert('RGB')
-        image = np.array(image)
-        w, h = image.shape[0], image.shape[1]
-        image, window, scale, padding, crop = self.resize_image(
-                                                image,
-                                                min_dim=1024,
-                                                min_scale=0,
-                                                max_dim=1024)
-        image = np.transpose(image, (2, 0, 1))
-
-        # Next we need to create the mask.
-        cat_ids = self.coco.getCatIds()
-        anns_ids = self.coco.getAnnIds(imgIds=img_id, catIds=cat_ids, iscrowd=None)
-        anns = self.coco.loadAnns(anns_ids)
-        mask = np.zeros((w, h))
-        for ann in anns:
-            if self.test:
-                mask = np.maximum(mask,self.coco.annToMask(ann)*ann['category_id'])
-            else:
-                mask = np.maximum(mask,self.coco.annToMask(ann)*(self.step+1))
-        mask = self.resize_mask(mask, scale, padding, crop)
-
-        # If augmentation is not None the image and the mask will be augmented
-        if self.transform is not None:
-            image = self.transform(image)
-            mask = self.transform(mask)
+        if self.cache_dir is not None:
+            if self.packed is None:
+                self.packed = self.open_packed()
+            if self.packed:
+                images, masks = self.packed
+                return torch.from_numpy(np.array(images[index])), torch.from_numpy(np.array(masks[index]))
+            sample = self.load_cached(self.ids[index])
+            if sample is not None:
+                return sample
 
+        image, mask = self.build_sample(index)
+        if self.cache_dir is not None:
+            self.save_cached(self.ids[index], image.numpy(), mask.numpy())
         return image, mask
 
     def __len__(self):
         return len(self.ids)
 
+    def build_sample(self, index):
+        """Loads and preprocesses one data pair, without using the cache."""
+        path, anns = self.images[index]
+        image, size = self.load_image(os.path.join(self.root, path), max_dim=1024)
+        if self.image_buffer is None:
+            self.image_buffer = np.empty((1024, 1024, 3), dtype=np.uint8)
+        # The image might have been decoded at a reduced size, the mask is
+        # built from the original size and only the window is shared
+        image, window, _, padding = self.resize_square(image, 1024, out=self.image_buffer)
+        mask = self.build_mask(anns, size, window, padding)
+
+        # HWC to CHW, the copy is done once by torch on the final image. It
+        # is also what makes the sample independent from image_buffer.
+        image = torch.from_numpy(image).permute(2, 0, 1).contiguous()
+        mask = torch.from_numpy(mask)
+
+        return image, mask
+
+    def fingerprint(self, annot_path):
+        """Returns a short hash of the annotation file and the image directory.
+
+        Annotation files with the same name but a different content, or an
+        edited annotation file, get a different cache directory.
+        """
+        digest = hashlib.md5(os.path.abspath(self.root).encode())
+        with open(annot_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def cache_paths(self, img_id):
+        """Returns the paths of the cached image and mask of an image id.
+
+        The mask depends on the step (or on test mode), the image does not.
+        """
+        label = "test" if self.test else f"step{self.step}"
+        return (os.path.join(self.cache_dir, f"{img_id}.img"),
+                os.path.join(self.cache_dir, f"{img_id}_{label}.mask"))
+
+    def packed_paths(self):
+        """Returns the paths of the packed images and masks."""
+        label = "test" if self.test else f"step{self.step}"
+        return (os.path.join(self.cache_dir, "images.bin"),
+                os.path.join(self.cache_dir, f"masks_{label}.bin"))
+
+    def open_packed(self):
+        """Opens the packed cache, returns () if it does not exist.
+
+        Samples are stored one after the other in the order of self.ids, so
+        reading a sample is a single contiguous read from one open file.
+        """
+        img_path, mask_path = self.packed_paths()
+        n = len(self)
+        if not (os.path.exists(img_path) and os.path.getsize(img_path) == n * 3 * 1024 * 1024
+                and os.path.exists(mask_path) and os.path.getsize(mask_path) == n * 1024 * 1024):
+            return ()
+        return (np.memmap(img_path, dtype=np.uint8, mode='r', shape=(n, 3, 1024, 1024)),
+                np.memmap(mask_path, dtype=np.uint8, mode='r', shape=(n, 1024, 1024)))
+
+    def pack_cache(self):
+        """Writes all the preprocessed samples to the packed cache.
+
+        Samples already in the per-sample cache are read from it, the others
+        are built without being added to it. Once written, the packed cache
+        is used by every dataset created with the same cache_dir, annotation
+        file and step.
+        """
+        assert self.cache_dir is not None, "cache_dir is required to pack the cache"
+        img_path, mask_path = self.packed_paths()
+        n = len(self)
+        images = np.memmap(img_path + ".tmp", dtype=np.uint8, mode='w+', shape=(n, 3, 1024, 1024))
+        masks = np.memmap(mask_path + ".tmp", dtype=np.uint8, mode='w+', shape=(n, 1024, 1024))
+        for i in tqdm(range(n)):
+            image, mask = self.load_cached(self.ids[i]) or self.build_sample(i)
+            images[i] = image.numpy()
+            masks[i] = mask.numpy()
+        images.flush()
+        masks.flush()
+        del images, masks
+        os.replace(img_path + ".tmp", img_path)
+        os.replace(mask_path + ".tmp", mask_path)
+        self.packed = None
+
+    def load_cached(self, img_id):
+        """Reads a preprocessed sample from the cache, None if missing."""
+        img_path, mask_path = self.cache_paths(img_id)
+        if not (os.path.exists(img_path) and os.path.exists(mask_path)):
+            return None
+        image = np.memmap(img_path, dtype=np.uint8, mode='r', shape=(3, 1024, 1024))
+        mask = np.memmap(mask_path, dtype=np.uint8, mode='r', shape=(1024, 1024))
+        return torch.from_numpy(np.array(image)), torch.from_numpy(np.array(mask))
+
+    def save_cached(self, img_id, image, mask):
+        """Writes a preprocessed sample to the cache.
+
+        Each file is written to a temporary path and then renamed, so that
+        other workers never read a partially written sample.
+        """
+        for path, array in zip(self.cache_paths(img_id), (image, mask)):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            cached = np.memmap(tmp_path, dtype=np.uint8, mode='w+', shape=array.shape)
+            cached[...] = array
+            cached.flush()
+            del cached
+            os.replace(tmp_path, path)
+
+    def build_mask(self, anns, size, window, padding):
+        """Builds the mask of an image resized and padded by resize_square().
+
+        size: (height, width) of the original image
+        window, padding: as returned by resize_square()
+        """
+        h, w = size
+        new_h, new_w = window[2] - window[0], window[3] - window[1]
+        (top_pad, bottom_pad), (left_pad, right_pad) = padding[:2]
+        if all(isinstance(ann['segmentation'], list) for ann in anns):
+            # polygons can be rasterized directly in the resized and padded
+            # image, there is no need to resize the mask afterwards
+            return self.anns_to_mask(anns, top_pad + new_h + bottom_pad, left_pad + new_w + right_pad,
+                                     scale=(new_w / w, new_h / h), offset=(left_pad, top_pad))
+        mask = self.anns_to_mask(anns, h, w)
+        return self.resize_mask(mask, new_h / h, padding, shape=(new_h, new_w))
+
+    def load_image(self, path, max_dim=None):
+        """Loads an image as an RGB uint8 array of shape (H, W, 3).
+
+        OpenCV decodes JPEGs with libjpeg-turbo, which is faster than PIL, so
+        it is used when available.
+
+        max_dim: if provided, JPEGs are decoded at 1/2, 1/4 or 1/8 of their
+            size, as long as the longest side stays at least max_dim. This
+            is done by the decoder itself and is much cheaper than decoding
+            the full image and resizing it afterwards.
+
+        Returns:
+        image: the decoded image
+        size: (height, width) of the original image
+        """
+        with Image.open(path) as im:
+            width, height = im.size
+            reduction = 1
+            if max_dim and im.format == 'JPEG':
+                for factor in (8, 4, 2):
+                    if max(width, height) >= factor * max_dim:
+                        reduction = factor
+                        break
+            if cv2 is None:
+                if reduction > 1:
+                    im.draft('RGB', (width // reduction, height // reduction))
+                return np.array(im.convert('RGB')), (height, width)
+
+        flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+        # PIL does not apply the EXIF orientation, neither should OpenCV
+        image = cv2.imread(path, flags[reduction] | cv2.IMREAD_IGNORE_ORIENTATION)
+        if image is None:
+            raise FileNotFoundError(path)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (height, width)
+
+    def anns_to_mask(self, anns, height, width, scale=1, offset=(0, 0)):
+        """Builds the label mask of a list of annotations.
+
+        When all the annotations are polygons and numba is available, they
+        are rasterized by rasterize_polys(). Otherwise, the annotations are
+        decoded by mask_utils.decode() in chunks of decode_chunk, so that the
+        (H, W, N) stack it returns stays bounded. In test mode each pixel
+        gets the highest category id among the annotations covering it,
+        otherwise it gets step + 1.
+
+        height, width: shape of the mask
+        scale, offset: see anns_to_rles()
+        """
+        if len(anns) == 0:
+            return np.zeros((height, width), dtype=np.uint8)
+        if self.test:
+            labels = np.array([ann['category_id'] for ann in anns], np.uint8)
+        else:
+            labels = np.full(len(anns), self.step+1, np.uint8)
+
+        if rasterize_polys is not None and all(isinstance(ann['segmentation'], list) for ann in anns):
+            polys = [(self.transform_poly(poly, scale, offset), label)
+                     for ann, label in zip(anns, labels) for poly in ann['segmentation']]
+            coords = np.concatenate([poly for poly, _ in polys])
+            offsets = np.cumsum([0] + [len(poly) for poly, _ in polys]).astype(np.int64)
+            poly_labels = np.array([label for _, label in polys], np.uint8)
+            return rasterize_polys(coords, offsets, poly_labels, height, width)
+
+        rles = self.anns_to_rles(anns, height, width, scale, offset)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for start in range(0, len(rles), self.decode_chunk):
+            # M is (H, W, n) with n <= decode_chunk
+            M = mask_utils.decode(rles[start:start + self.decode_chunk])
+            chunk_labels = labels[start:start + self.decode_chunk]
+            np.maximum(mask, (M * chunk_labels[None, None, :]).max(-1), out=mask)
+        return mask
+
+    def anns_to_rles(self, anns, height, width, scale=1, offset=(0, 0)):
+        """Converts the segmentation of each annotation to a single RLE.
+
+        Same conversion as COCO.annToRLE(), done for a list of annotations so
+        that all of them can be decoded together by mask_utils.decode().
+
+        scale, offset: see transform_poly(). They are not applied to RLE
+            annotations.
+        """
+        rles = []
+        for ann in anns:
+            segm = ann['segmentation']
+            if isinstance(segm, list):
+                if scale != 1 or offset != (0, 0):
+                    segm = [self.transform_poly(poly, scale, offset).ravel().tolist()
+                            for poly in segm]
+                # polygon -- a single object might consist of multiple parts
+                rle = mask_utils.merge(mask_utils.frPyObjects(segm, height, width))
+            elif isinstance(segm['counts'], list):
+                # uncompressed RLE
+                rle = mask_utils.frPyObjects(segm, height, width)
+            else:
+                # compressed RLE
+                rle = segm
+            rles.append(rle)
+        return rles
+
+    def transform_poly(self, poly, scale=1, offset=(0, 0)):
+        """Returns the vertices of a COCO polygon as a float64 array (K, 2).
+
+        scale: scaling factor applied to the coordinates, or a pair of (x, y)
+            scaling factors
+        offset: (x, y) translation applied to the coordinates after scaling
+        """
+        return np.asarray(poly, dtype=np.float64).reshape(-1, 2) * scale + offset
+
     def resize_image(self, image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
         """Resizes an image keeping the aspect ratio unchanged.
 
@@ -145,8 +394,7 @@ class CocoDataset(data.Dataset):
 
         # Resize image using bilinear interpolation
         if scale != 1:
-            image = self.resize(image, (round(h * scale), round(w * scale)),
-                          preserve_range=True)
+            image = self.resize(image, (round(h * scale), round(w * scale)))
 
         # Need padding or cropping?
         if mode == "square":
@@ -157,7 +405,7 @@ class CocoDataset(data.Dataset):
             left_pad = (max_dim - w) // 2
             right_pad = max_dim - w - left_pad
             padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-            image = np.pad(image, padding, mode='constant', constant_values=0)
+            image = self.pad(image, padding)
             window = (top_pad, left_pad, h + top_pad, w + left_pad)
         elif mode == "pad64":
             h, w = image.shape[:2]
@@ -178,7 +426,7 @@ class CocoDataset(data.Dataset):
             else:
                 left_pad = right_pad = 0
             padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
-            image = np.pad(image, padding, mode='constant', constant_values=0)
+            image = self.pad(image, padding)
             window = (top_pad, left_pad, h + top_pad, w + left_pad)
         elif mode == "crop":
             # Pick a random crop
@@ -193,7 +441,81 @@ class CocoDataset(data.Dataset):
         return image.astype(image_dtype), window, scale, padding, crop
 
 
-    def resize_mask(self, mask, scale, padding, crop=None):
+    def resize_square(self, image, dim, out=None):
+        """Resizes and pads an image to a square of size [dim, dim].
+
+        Same result as resize_image(image, min_dim=dim, max_dim=dim,
+        min_scale=0, mode="square"), without the generic mode handling.
+
+        out: if provided, array of shape [dim, dim, channels] the result is
+            written to, so that no new array is allocated. It is overwritten
+            by the next call, copy the result before reusing it.
+
+        Returns:
+        image, window, scale, padding: see resize_image()
+        """
+        window, scale, padding = self.square_geometry(image.shape[:2], dim)
+        (top_pad, _), (left_pad, _) = padding[:2]
+        new_h, new_w = window[2] - top_pad, window[3] - left_pad
+
+        if out is None:
+            if scale != 1:
+                image = self.resize(image, (new_h, new_w))
+            return self.pad(image, padding), window, scale, padding
+
+        # Zero the padding and resize directly into the rest of the buffer
+        out[:top_pad] = 0
+        out[top_pad + new_h:] = 0
+        out[top_pad:top_pad + new_h, :left_pad] = 0
+        out[top_pad:top_pad + new_h, left_pad + new_w:] = 0
+        dst = out[top_pad:top_pad + new_h, left_pad:left_pad + new_w]
+        if scale != 1:
+            self.resize(image, (new_h, new_w), dst=dst)
+        else:
+            dst[...] = image
+        return out, window, scale, padding
+
+    def square_geometry(self, size, dim):
+        """Computes how resize_square() resizes and pads an image.
+
+        size: (height, width) of the image
+
+        Returns:
+        window, scale, padding: see resize_image()
+        """
+        h, w = size
+        # Scale up to dim but not down, then make sure the longest side
+        # does not exceed dim
+        scale = max(1, dim / min(h, w))
+        image_max = max(h, w)
+        if round(image_max * scale) > dim:
+            scale = dim / image_max
+        new_h, new_w = (round(h * scale), round(w * scale)) if scale != 1 else (h, w)
+
+        top_pad = (dim - new_h) // 2
+        bottom_pad = dim - new_h - top_pad
+        left_pad = (dim - new_w) // 2
+        right_pad = dim - new_w - left_pad
+        padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
+        window = (top_pad, left_pad, new_h + top_pad, new_w + left_pad)
+        return window, scale, padding
+
+    def pad(self, image, padding):
+        """Pads an image with zeros.
+
+        OpenCV copyMakeBorder() does it in a single pass and is faster than
+        np.pad(), so it is used when available.
+
+        padding: [(top, bottom), (left, right), (0, 0)] as returned by
+            resize_image(). The last entry is optional.
+        """
+        (top_pad, bottom_pad), (left_pad, right_pad) = padding[:2]
+        if cv2 is not None:
+            return cv2.copyMakeBorder(image, top_pad, bottom_pad, left_pad, right_pad,
+                                      cv2.BORDER_CONSTANT, value=0)
+        return np.pad(image, padding[:image.ndim], mode='constant', constant_values=0)
+
+    def resize_mask(self, mask, scale, padding, crop=None, shape=None):
         """Resizes a mask using the given scale and padding.
         Typically, you get the scale and padding from resize_image() to
         ensure both, the image and the mask, are resized consistently.
@@ -201,40 +523,53 @@ class CocoDataset(data.Dataset):
         scale: mask scaling factor
         padding: Padding to add to the mask in the form
                 [(top, bottom), (left, right), (0, 0)]
+        shape: if provided, (height, width) of the resized mask before
+            padding, otherwise it is computed from scale. Not used with crop.
         """
-        # Suppress warning from scipy 0.13.0, the output shape of zoom() is
-        # calculated with round() instead of int()
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            mask = scipy.ndimage.zoom(mask, zoom=[scale, scale], order=0)
+        # masks are uint8 label maps, this is a no-op unless the caller
+        # passes another dtype
+        mask = mask.astype(np.uint8, copy=False)
+        h, w = mask.shape[:2]
         if crop is not None:
+            if scale != 1:
+                mask = self.resize(mask, (round(h * scale), round(w * scale)), order=0)
             y, x, h, w = crop
-            mask = mask[y:y + h, x:x + w]
-        else:
-            padding.pop(2)
-            mask = np.pad(mask, padding, mode='constant', constant_values=0)
-        return mask
+            return mask[y:y + h, x:x + w]
 
-    def resize(self, image, output_shape, order=1, mode='constant', cval=0, clip=True,
-               preserve_range=False, anti_aliasing=False, anti_aliasing_sigma=None):
-        """A wrapper for Scikit-Image resize().
-
-        Scikit-Image generates warnings on every call to resize() if it doesn't
-        receive the right parameters. The right parameters depend on the version
-        of skimage. This solves the problem by using different parameters per
-        version. And it provides a central place to control resizing defaults.
-        """
-        if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
-            # New in 0.14: anti_aliasing. Default it to False for backward
-            # compatibility with skimage 0.13.
-            return skimage.transform.resize(
-                image, output_shape,
-                order=order, mode=mode, cval=cval, clip=clip,
-                preserve_range=preserve_range, anti_aliasing=anti_aliasing,
-                anti_aliasing_sigma=anti_aliasing_sigma)
-        else:
-            return skimage.transform.resize(
-                image, output_shape,
-                order=order, mode=mode, cval=cval, clip=clip,
-                preserve_range=preserve_range)
-    
\ No newline at end of file
+        # Allocate the padded mask once and resize directly into the window
+        # that is not padding, output shape is computed with round() the same
+        # way as in resize_image()
+        (top_pad, bottom_pad), (left_pad, right_pad) = padding[:2]
+        new_h, new_w = shape if shape is not None else (round(h * scale), round(w * scale))
+        out = np.zeros((top_pad + new_h + bottom_pad, left_pad + new_w + right_pad),
+                       dtype=mask.dtype)
+        self.resize(mask, (new_h, new_w), order=0,
+                    dst=out[top_pad:top_pad + new_h, left_pad:left_pad + new_w])
+        return out
+
+    def resize(self, image, output_shape, order=1, dst=None):
+        """A wrapper for image resizing that preserves the range and dtype.
+
+        OpenCV resize() runs in optimized native code and is much faster than
+        Scikit-Image, so it is used when available. Scikit-Image resize() is
+        kept as a fallback. It provides a central place to control resizing
+        defaults.
+
+        output_shape: (height, width) of the resized image
+        order: 0 for nearest-neighbor, 1 for bilinear interpolation
+        dst: if provided, array of shape output_shape (possibly a view into a
+            larger array) the result is written to. It is also returned.
+        """
+        if cv2 is not None:
+            interpolation = cv2.INTER_NEAREST if order == 0 else cv2.INTER_LINEAR
+            # cv2 expects the size as (width, height)
+            return cv2.resize(image, (output_shape[1], output_shape[0]), dst=dst,
+                              interpolation=interpolation)
+        resized = skimage.transform.resize(
+            image, output_shape,
+            order=order, mode='constant', cval=0, clip=True,
+            preserve_range=True, anti_aliasing=False).astype(image.dtype)
+        if dst is None:
+            return resized
+        dst[...] = resized
+        return dst
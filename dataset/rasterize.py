@@ -0,0 +1,59 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def rasterize_polys(coords, offsets, labels, height, width):
+    """Rasterizes a set of polygons into a single label map.
+
+    Scanline fill with the even-odd rule, a pixel belongs to a polygon when
+    its center is inside it. Each pixel gets the highest label among the
+    polygons covering it. It runs on a single thread: it is called from the
+    DataLoader workers, which already process samples in parallel, and
+    numba's thread pool is not fork-safe.
+
+    Args:
+        coords: float64 array (K, 2) with the (x, y) vertices of all the
+            polygons, one after the other.
+        offsets: int64 array (P + 1,), vertices of polygon p are
+            coords[offsets[p]:offsets[p + 1]].
+        labels: uint8 array (P,) with the label of each polygon.
+        height, width: shape of the label map.
+    """
+    mask = np.zeros((height, width), dtype=np.uint8)
+    n_polys = offsets.shape[0] - 1
+    y_min = np.empty(n_polys, dtype=np.float64)
+    y_max = np.empty(n_polys, dtype=np.float64)
+    for p in range(n_polys):
+        if offsets[p + 1] - offsets[p] < 3:
+            # degenerate polygon, never crosses any row
+            y_min[p], y_max[p] = np.inf, -np.inf
+        else:
+            y_min[p] = coords[offsets[p]:offsets[p + 1], 1].min()
+            y_max[p] = coords[offsets[p]:offsets[p + 1], 1].max()
+
+    xs = np.empty(coords.shape[0], dtype=np.float64)
+    for y in range(height):
+        yc = y + 0.5
+        for p in range(n_polys):
+            if yc < y_min[p] or yc > y_max[p]:
+                continue
+            start, end = offsets[p], offsets[p + 1]
+            # x coordinate of the crossings between the edges and the row
+            n = 0
+            for i in range(start, end):
+                j = i + 1 if i + 1 < end else start
+                x0, y0 = coords[i, 0], coords[i, 1]
+                x1, y1 = coords[j, 0], coords[j, 1]
+                if (y0 <= yc) != (y1 <= yc):
+                    xs[n] = x0 + (yc - y0) * (x1 - x0) / (y1 - y0)
+                    n += 1
+            row = np.sort(xs[:n])
+            # fill the pixels whose center lies in [row[k], row[k + 1])
+            for k in range(0, n - 1, 2):
+                x_start = max(int(np.ceil(row[k] - 0.5)), 0)
+                x_end = min(int(np.ceil(row[k + 1] - 0.5)), width)
+                for x in range(x_start, x_end):
+                    if mask[y, x] < labels[p]:
+                        mask[y, x] = labels[p]
+    return mask
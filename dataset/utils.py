@@ -1,3 +1,4 @@
+import pickle
 from tqdm import tqdm
 import torch
 import numpy as np
@@ -107,6 +108,30 @@ class Subset(torch.utils.data.Dataset):
 
 
 
+class SerializedList:
+    """
+    List of python objects stored as pickled bytes in a single numpy array.
+    Reading an item does not touch the reference count of any shared python
+    object, so DataLoader workers forked from the main process keep sharing
+    the memory pages instead of copying them one by one.
+    Arguments:
+        lst (list): The objects to store
+    """
+
+    def __init__(self, lst):
+        lst = [np.frombuffer(pickle.dumps(x, protocol=-1), dtype=np.uint8) for x in lst]
+        self.addr = np.cumsum([len(x) for x in lst], dtype=np.int64)
+        self.data = np.concatenate(lst) if len(lst) > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __getitem__(self, idx):
+        start = 0 if idx == 0 else self.addr[idx - 1].item()
+        end = self.addr[idx].item()
+        return pickle.loads(memoryview(self.data[start:end]))
+
+    def __len__(self):
+        return len(self.addr)
+
+
 class MaskLabels:
     """
     Use this class to mask labels that you don't want in your dataset.
@@ -0,0 +1,27 @@
+import argparse
+
+from dataset.dent import CocoDataset
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(
+        description="Pack the preprocessed samples of the dent dataset in a single file "
+                    "that is read by run.py when --cache_dir is given.")
+    parser.add_argument("--data_root", type=str, default='data',
+                        help="path to Dataset")
+    parser.add_argument("--annot_path", type=str, required=True,
+                        help="path to the coco annotation file")
+    parser.add_argument("--step", type=int, default=0,
+                        help="The incremental step the annotation file is used for (default: 0)")
+    parser.add_argument("--test", action='store_true', default=False,
+                        help="Pack the masks with the category ids, as used for testing")
+    parser.add_argument("--cache_dir", type=str, required=True,
+                        help="path to the cache of preprocessed samples")
+    return parser
+
+
+if __name__ == '__main__':
+    opts = get_argparser().parse_args()
+    dataset = CocoDataset(root=opts.data_root, annot_path=opts.annot_path, step=opts.step,
+                          test=opts.test, cache_dir=opts.cache_dir)
+    dataset.pack_cache()
@@ -43,6 +43,21 @@ def save_ckpt(path, model, trainer, optimizer, scheduler, epoch, best_score):
     torch.save(state, path)
 
 
+def get_loader(opts, dst, batch_size):
+    """ DataLoader, or DALI loader for our dataset when requested.
+    On GPU, batches are copied to the device ahead of time on a side stream.
+    """
+    if opts.dali:
+        from dataset.dali import DaliLoader
+        return DaliLoader(dst, batch_size=batch_size, num_threads=opts.num_workers,
+                          py_num_workers=opts.num_workers, device_id=opts.local_rank)
+    loader = data.DataLoader(dst, batch_size=batch_size, num_workers=opts.num_workers,
+                             pin_memory=True)
+    if cuda.is_available():
+        return utils.CudaPrefetcher(loader, torch.device('cuda'))
+    return loader
+
+
 def get_dataset(opts):
     """ Dataset And Augmentation
     """
@@ -99,7 +114,7 @@ def get_dataset(opts):
         # get path to annotation file then get then dataset object
         annot_path = os.path.join(opts.annot_root, (dent_dataset.classes[(opts.step+1)]+"_train.json"))
         train_dst = dataset(root=opts.data_root, annot_path=annot_path, 
-                            step=opts.step)
+                            step=opts.step, cache_dir=opts.cache_dir)
                           
 
     if not opts.no_cross_val:  # if opts.cross_val:
@@ -117,7 +132,7 @@ def get_dataset(opts):
             # get path to annotation file then get then dataset object
             annot_path = os.path.join(opts.annot_root, (dent_dataset.classes[(opts.step+1)]+"_val.json"))
             val_dst = dataset(root=opts.data_root, annot_path=annot_path, 
-                                step=opts.step)
+                                step=opts.step, cache_dir=opts.cache_dir)
 
     image_set = 'train' if opts.val_on_trainset else 'val'
     if opts.dataset != 'dent':
@@ -132,15 +147,18 @@ def get_dataset(opts):
             # -------##### also change the annot path to the whole dataset #####--------
             # Validation of PERM dataset as test dataset
             annot_path = os.path.join(opts.annot_root, (dent_dataset.classes[(opts.step)]+"_val.json"))
-            test_dst = dataset(root=opts.data_root, annot_path=annot_path, step=0)
+            test_dst = dataset(root=opts.data_root, annot_path=annot_path, step=0,
+                               cache_dir=opts.cache_dir)
         else:
             # Validation of PERM dataset as first test dataset
             annot_path = os.path.join(opts.annot_root, (dent_dataset.classes[(opts.step-1)]+"_val.json"))
-            test_dst_1 = dataset(root=opts.data_root, annot_path=annot_path, step=0)
+            test_dst_1 = dataset(root=opts.data_root, annot_path=annot_path, step=0,
+                                 cache_dir=opts.cache_dir)
             
             # Validation of PRIM dataset as second test dataset
             annot_path = os.path.join(opts.annot_root, (dent_dataset.classes[(opts.step)]+"_val.json"))
-            test_dst_2 = dataset(root=opts.data_root, annot_path=annot_path, step=1)
+            test_dst_2 = dataset(root=opts.data_root, annot_path=annot_path, step=1,
+                                 cache_dir=opts.cache_dir)
 
             return train_dst, val_dst, test_dst_1, test_dst_2, len(labels_cum)
 
@@ -181,10 +199,8 @@ def main(opts):
     random.seed(opts.random_seed)
 
     #####################################################################################
-    train_loader = data.DataLoader(train_dst, batch_size=opts.batch_size,
-                                   num_workers=opts.num_workers,)
-    val_loader = data.DataLoader(val_dst, batch_size=opts.batch_size if opts.crop_val else 1,
-                                   num_workers=opts.num_workers)
+    train_loader = get_loader(opts, train_dst, opts.batch_size)
+    val_loader = get_loader(opts, val_dst, opts.batch_size if opts.crop_val else 1)
     if opts.dataset == 'dent' and opts.step == 2:
         logger.info(f"Dataset: {opts.dataset}, Train set: {len(train_dst)}, Val set: {len(val_dst)},"
                     f" Test set: {len(test_dst_1)} _ {len(test_dst_2)}, n_classes {n_classes}")
@@ -381,8 +397,7 @@ def main(opts):
     # make data loader
 
     if opts.dataset != 'dent' or opts.step != 2:
-        test_loader = data.DataLoader(test_dst, batch_size=opts.batch_size if opts.crop_val else 1,
-                                  num_workers=opts.num_workers)
+        test_loader = get_loader(opts, test_dst, opts.batch_size if opts.crop_val else 1)
         #we want print the samples
         tot = len(test_loader)
         sample_ids = np.array([5,tot//4,tot//2,tot//4+tot//2,tot-5])
@@ -428,8 +443,7 @@ def main(opts):
 
     elif opts.dataset == 'dent' and opts.step == 2:
         # First testset
-        test_loader_1 = data.DataLoader(test_dst_1, batch_size=opts.batch_size if opts.crop_val else 1,
-                                  num_workers=opts.num_workers)
+        test_loader_1 = get_loader(opts, test_dst_1, opts.batch_size if opts.crop_val else 1)
         #we want print the samples
         tot = len(test_loader_1)
         sample_ids = np.array([5,tot//4,tot//2,tot//4+tot//2,tot-5])
@@ -452,8 +466,7 @@ def main(opts):
         logger.close()
 
         # Second test loader
-        test_loader_2 = data.DataLoader(test_dst_2, batch_size=opts.batch_size if opts.crop_val else 1,
-                                  num_workers=opts.num_workers)
+        test_loader_2 = get_loader(opts, test_dst_2, opts.batch_size if opts.crop_val else 1)
         #we want print the samples
         tot = len(test_loader_2)
         sample_ids = np.array([5,tot//4,tot//2,tot//4+tot//2,tot-5])
@@ -68,13 +68,24 @@ class Trainer:
 
         self.ret_intermediate = self.lde
 
+    def to_device(self, images, labels):
+        """Moves a batch to the device.
+
+        uint8 images (dent dataset) are converted to float here, on the
+        device, so the DataLoader only has to transfer 8-bit data. As before,
+        they keep their 0-255 range.
+        """
+        images = images.to(self.device, non_blocking=True)
+        images = images.to(dtype=torch.float32)
+        labels = labels.to(self.device, dtype=torch.long, non_blocking=True)
+        return images, labels
+
     def train(self, cur_epoch, optim, train_loader, scheduler=None, print_int=90, logger=None):
         """Train and return epoch loss"""
         logger.info("Epoch %d, lr = %f" % (cur_epoch, optim.param_groups[0]['lr']))
         
         tqlt = tqdm(total=len(train_loader)*self.batch_size)
         #tqlt = tqlt * batch_size
-        device = self.device
         model = self.model
         criterion = self.criterion
 
@@ -90,8 +101,7 @@ class Trainer:
         model.train()
         for cur_step, (images, labels) in enumerate(train_loader):
 
-            images = images.to(device, dtype=torch.float32)
-            labels = labels.to(device, dtype=torch.long)
+            images, labels = self.to_device(images, labels)
             with amp.autocast():
                 if (self.lde_flag or self.lkd_flag or self.icarl_dist_flag) and self.model_old is not None:
                     with torch.no_grad():
@@ -194,7 +204,6 @@ class Trainer:
         """Do validation and return specified samples"""
         metrics.reset()
         model = self.model
-        device = self.device
         criterion = self.criterion
         model.eval()
 
@@ -209,8 +218,7 @@ class Trainer:
         with torch.no_grad():
             for i, (images, labels) in enumerate(loader):
 
-                images = images.to(device, dtype=torch.float32)
-                labels = labels.to(device, dtype=torch.long)
+                images, labels = self.to_device(images, labels)
 
                 if (self.lde_flag or self.lkd_flag or self.icarl_dist_flag) and self.model_old is not None:
                     with torch.no_grad():
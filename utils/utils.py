@@ -1,4 +1,5 @@
 from torchvision.transforms.functional import normalize
+import torch
 import torch.nn as nn
 import numpy as np
 
@@ -25,6 +26,39 @@ class Denormalize(object):
         return normalize(tensor, self._mean, self._std)
 
 
+class CudaPrefetcher(object):
+    """Iterates over a DataLoader, copying the next batch to the GPU on a side
+    stream while the current batch is being processed.
+
+    The DataLoader should use pin_memory=True, so that the copies are
+    asynchronous. Batches are yielded as tuples of tensors on the device.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = tuple(t.to(self.device, non_blocking=True) for t in next_batch)
+            if batch is not None:
+                # the copy of next_batch overlaps with the processing of batch
+                yield batch
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for t in next_batch:
+                # the memory is allocated on the side stream but used on the current one
+                t.record_stream(current_stream)
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
 def fix_bn(model):
     for m in model.modules():
         if isinstance(m, nn.BatchNorm2d):